@@ -1,21 +1,26 @@
 """Utility functions for MAP calculation, priors and finding the best parameters."""
 import json
-from collections import Counter
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
+from itertools import groupby
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 import dill as pickle
 import numpy as np
 import pandas as pd
 import yaml
+from joblib import Parallel, delayed
 from more_itertools import powerset
-from mouselab.cost_functions import *  # noqa
+from mouselab import cost_functions
 from mouselab.distributions import Categorical
 from mouselab.graph_utils import get_structure_properties
 from mouselab.policies import SoftmaxPolicy
 from scipy import stats  # noqa
 from scipy.stats import rv_continuous
-from statsmodels.tools.eval_measures import bic
 
 from costometer.agents import SymmetricMouselabParticipant
 from costometer.utils.cost_utils import adjust_state, get_state_action_values
@@ -23,6 +28,53 @@ from costometer.utils.plotting_utils import generate_model_palette
 from costometer.utils.trace_utils import get_trajectories_from_participant_data
 
 
+@lru_cache(maxsize=None)
+def _cached_yaml(yaml_file: str, mtime: float) -> Dict[str, Any]:
+    with open(yaml_file, "r") as stream:
+        return yaml.safe_load(stream)
+
+
+# loaded pickles by path, with the modification time they were loaded at so a
+# rewritten file replaces its old entry, bounded since pickles can be large
+_PICKLE_CACHE_SIZE = 256
+_pickle_cache = {}
+
+
+def _cached_pickle(pickle_file: str, mtime: float) -> Any:
+    cached_mtime, loaded = _pickle_cache.get(pickle_file, (None, None))
+    if cached_mtime != mtime:
+        with open(pickle_file, "rb") as f:
+            loaded = pickle.load(f)
+        # replace entry of a rewritten file, and drop oldest pickle if cache is full
+        _pickle_cache.pop(pickle_file, None)
+        if len(_pickle_cache) >= _PICKLE_CACHE_SIZE:
+            del _pickle_cache[next(iter(_pickle_cache))]
+        _pickle_cache[pickle_file] = (mtime, loaded)
+    return loaded
+
+
+def load_yaml(yaml_file: Union[str, Path]) -> Dict[str, Any]:
+    """
+    Load YAML file, reusing the parsed contents while the file is unchanged.
+
+    :param yaml_file: path to YAML file
+    :return: copy of the parsed YAML dictionary
+    """
+    yaml_file = Path(yaml_file)
+    return deepcopy(_cached_yaml(str(yaml_file), yaml_file.stat().st_mtime))
+
+
+def load_pickle(pickle_file: Union[str, Path]) -> Any:
+    """
+    Load pickle file, reusing the loaded object while the file is unchanged.
+
+    :param pickle_file: path to pickle file
+    :return: loaded object, shared between calls so it should not be modified
+    """
+    pickle_file = Path(pickle_file)
+    return _cached_pickle(str(pickle_file), pickle_file.stat().st_mtime)
+
+
 def get_best_parameters(
     df: pd.DataFrame,
     cost_details: Dict[str, Any],
@@ -41,93 +93,88 @@ def get_best_parameters(
     # reset index's df for the indexing by best row
     df = df.reset_index()
 
-    df["num_constant"] = df.apply(
-        lambda row: sum(
-            [
-                row[param] == val
-                for param, val in cost_details["constant_values"].items()
-            ]
-        ),
-        axis=1,
+    # (row, parameter) matrix of whether parameter is held at its constant value
+    constant_params = list(cost_details["constant_values"])
+    const_mat = np.column_stack(
+        [
+            df[param].values == val
+            for param, val in cost_details["constant_values"].items()
+        ]
     )
+    df["num_constant"] = const_mat.sum(axis=1)
+
+    # rows where every parameter in subset is held constant, shared across priors
+    # uniform should always be provided
+    uniform_params = list(priors["uniform"])
+    is_const = const_mat[:, [constant_params.index(param) for param in uniform_params]]
+    subset_masks = {
+        subset: is_const[:, [uniform_params.index(param) for param in subset]].all(
+            axis=1
+        )
+        for subset in powerset(uniform_params)
+    }
 
     for prior_type, prior_dict in priors.items():
         # save best parameters for each prior
         best_parameter_values[prior_type] = {}
-        # uniform should always be provided
-        for subset in powerset(priors["uniform"]):
+
+        # (row, parameter) matrix of log prior of each row's parameter value
+        prior_params = list(prior_dict.keys())
+        log_prior_mat = np.column_stack(
+            [
+                df[param]
+                .map({val: np.log(prob) for val, prob in prior_dict[param].items()})
+                .to_numpy(dtype=np.float64)
+                for param in prior_params
+            ]
+        )
+
+        for subset, subset_mask in subset_masks.items():
             # subset dataframe
-            curr_data = (
-                df[
-                    df.apply(
-                        lambda row: sum(
-                            row[cost_param]
-                            == cost_details["constant_values"][cost_param]
-                            for cost_param in list(subset)  # noqa : B023
-                        )
-                        == len(list(subset)),  # noqa : B023
-                        axis=1,
-                    )
-                ]
-                .copy(deep=True)
-                .reset_index(drop=True)
-            )
+            curr_data = df[subset_mask].reset_index(drop=True)
 
             # add prior
-            curr_data[f"map_{prior_type}"] = curr_data.apply(
-                lambda row: row["mle"]
-                + sum(
-                    [
-                        np.log(prior_dict[param][row[param]])  # noqa : B023
-                        for param in prior_dict.keys()  # noqa : B023
-                        if param not in subset  # noqa : B023
-                    ]
-                ),
-                axis=1,
-            )
+            varied_idx = [
+                param_idx
+                for param_idx, param in enumerate(prior_params)
+                if param not in subset
+            ]
+            log_prior = log_prior_mat[np.ix_(subset_mask, varied_idx)].sum(axis=1)
+            curr_data[f"map_{prior_type}"] = curr_data["mle"].to_numpy() + log_prior
 
             # when multiple pids included,
             # some might be duplicated (e.g. pid 0 with sim cost 1 vs 2)
             sim_cols = [col for col in list(curr_data) if "sim_" in col]
 
-            max_values = curr_data.groupby(["trace_pid"] + sim_cols).max(
-                numeric_only=True
-            )[f"map_{prior_type}"]
-
-            # rows which tie for max MAP
-            best_param_rows = [
-                df[df[f"map_{prior_type}"] == max_values[key]]
-                for key, df in curr_data.groupby(["trace_pid"] + sim_cols)
-            ]
-
-            # favor rows with more constant values
-            best_param_rows = pd.concat(
-                [
-                    pid_best_param_rows.loc[
-                        pid_best_param_rows["num_constant"].idxmax()
-                    ]
-                    .to_frame()
-                    .T
-                    for pid_best_param_rows in best_param_rows
-                ]
+            # take row with max MAP, favoring rows with more constant values on ties
+            best_param_rows = (
+                curr_data.sort_values(
+                    [f"map_{prior_type}", "num_constant"], ascending=False
+                )
+                .drop_duplicates(subset=["trace_pid"] + sim_cols, keep="first")
+                .reset_index(drop=True)
             )
 
-            assert np.all(
-                [
-                    counter == 1
-                    for pid, counter in Counter(
-                        best_param_rows[["trace_pid"] + sim_cols]
-                        .to_records(index=False)
-                        .tolist()
-                    ).most_common()
-                ]
-            )
+            assert not best_param_rows.duplicated(subset=["trace_pid"] + sim_cols).any()
 
             best_parameter_values[prior_type][subset] = best_param_rows
 
     return best_parameter_values
 
 
+def _non_string_values(values: pd.Series) -> np.ndarray:
+    """
+    Get entries of a column which are not strings.
+
+    :param values: column which may mix (numeric) values and strings
+    :return: array of non-string entries
+    """
+    # numeric columns can't hold strings, skip checking every entry
+    if not pd.api.types.is_numeric_dtype(values):
+        values = values[[not isinstance(entry, str) for entry in values]]
+    return values.to_numpy()
+
+
 def add_cost_priors_to_temp_priors(
     softmax_df: pd.DataFrame,
     cost_details: Dict[str, Any],
@@ -154,12 +201,7 @@ def add_cost_priors_to_temp_priors(
         priors["temp"] = dict(zip(prior_inputs["possible_temps"], temp_prior.probs))
 
         for additional_param in additional_params:
-            numeric_values = softmax_df[additional_param][
-                softmax_df[additional_param].apply(
-                    lambda entry: not isinstance(entry, str)
-                )
-            ]
-            unique_args = np.unique(numeric_values)
+            unique_args = np.unique(_non_string_values(softmax_df[additional_param]))
             additional_prior = get_prior(
                 rv=eval(prior_inputs["rv"]),
                 possible_vals=[1 - possible_val for possible_val in unique_args],
@@ -171,12 +213,7 @@ def add_cost_priors_to_temp_priors(
             ["temp"] + additional_params
         )
         for cost_parameter_arg in uniform_params:
-            numeric_values = softmax_df[cost_parameter_arg][
-                softmax_df[cost_parameter_arg].apply(
-                    lambda entry: not isinstance(entry, str)
-                )
-            ]
-            unique_args = np.unique(numeric_values)
+            unique_args = np.unique(_non_string_values(softmax_df[cost_parameter_arg]))
             priors[cost_parameter_arg] = dict(
                 zip(unique_args, np.ones(len(unique_args)) * 1 / len(unique_args))
             )
@@ -229,13 +266,112 @@ def get_prior(rv: rv_continuous, possible_vals: List[float]) -> Categorical:
     :param possible_vals:
     :return:
     """
-    normalizing_factor = sum([rv.pdf(val) for val in possible_vals])
-    categorical_dist = Categorical(
-        possible_vals, [rv.pdf(val) / normalizing_factor for val in possible_vals]
-    )
+    pdfs = rv.pdf(np.asarray(possible_vals, dtype=np.float64))
+    categorical_dist = Categorical(possible_vals, (pdfs / pdfs.sum()).tolist())
     return categorical_dist
 
 
+def _compute_trial_by_trial_for_config(
+    config: Dict[str, Any],
+    pid_data: Dict[Any, Tuple[pd.DataFrame, float]],
+    experiment_setting: str,
+    structure_dicts: Dict[str, Any],
+    cost_details: Dict[str, Any],
+    cost_function: Callable,
+    bmps_path: Path,
+    blocks: List[str],
+) -> Dict[Any, List[Any]]:
+    """
+    Compute trial by trial likelihoods for participants sharing best parameters.
+
+    :param config: best parameters shared by all participants in pid_data
+    :param pid_data: pid mapped to (mouselab-mdp dataframe, mle) for that pid
+    :param experiment_setting:
+    :param structure_dicts:
+    :param cost_details:
+    :param cost_function:
+    :param bmps_path:
+    :param blocks: blocks included in the mle
+    :return: pid mapped to trial by trial likelihoods
+    """
+    policy_kwargs = {
+        key: val
+        for key, val in config.items()
+        if key not in cost_details["cost_parameter_args"]
+    }
+
+    cost_kwargs = {
+        key: val
+        for key, val in config.items()
+        if key in cost_details["cost_parameter_args"]
+    }
+
+    policy_kwargs["noise"] = 0
+    policy_kwargs["preference"] = get_state_action_values(
+        experiment_setting=experiment_setting,
+        bmps_file="Myopic_VOC",
+        bmps_path=bmps_path,
+        cost_function=cost_function,
+        cost_parameters=cost_kwargs,
+        structure=structure_dicts,
+        env_params=cost_details["env_params"],
+        kappa=policy_kwargs["kappa"],
+        gamma=policy_kwargs["gamma"],
+    )
+
+    trial_by_trial = {}
+    for pid, (pid_df, mle) in pid_data.items():
+        traces = get_trajectories_from_participant_data(
+            pid_df,
+            experiment_setting=experiment_setting,
+            include_last_action=cost_details["env_params"]["include_last_action"],
+        )
+
+        participant = SymmetricMouselabParticipant(
+            experiment_setting=experiment_setting,
+            policy_function=SoftmaxPolicy,
+            additional_mouselab_kwargs={
+                "mdp_graph_properties": structure_dicts,
+                **cost_details["env_params"],
+            },
+            num_trials=max([len(trace["actions"]) for trace in traces]),
+            cost_function=cost_function,
+            cost_kwargs=cost_kwargs,
+            policy_kwargs={
+                key: val
+                for key, val in policy_kwargs.items()
+                if key not in ["gamma", "kappa"]
+            },
+        )
+
+        for trace in traces:
+            trace["states"] = [
+                [
+                    adjust_state(
+                        state,
+                        policy_kwargs["gamma"],
+                        participant.mouselab_envs[0].mdp_graph.nodes.data("depth"),
+                        True,
+                    )
+                    for state in trial
+                ]
+                for trial in trace["states"]
+            ]
+
+            trial_by_trial[pid] = participant.compute_likelihood(trace)
+
+            sum_trial_by_trial = sum(
+                [
+                    sum(trial_ll)
+                    for block, trial_ll in zip(trace["block"], trial_by_trial[pid])
+                    if block in blocks
+                ]
+            )
+            assert (sum_trial_by_trial - mle) < 1e-3
+
+    return trial_by_trial
+
+
 class AnalysisObject:
     def __init__(
         self,
@@ -265,21 +401,29 @@ class AnalysisObject:
         if not hasattr(self, "palette_name"):
             self.palette_name = experiment_name
 
-        dfs = {}
-        for session in self.sessions:
-            matching_files = (self.irl_path / "data" / "processed" / f"{session}").glob(
-                "*.csv"
-            )
-            for matching_file in matching_files:
-                curr_df = pd.read_csv(matching_file, index_col=0)
-                curr_df["session"] = session
-
-                if matching_file.stem not in dfs:
-                    dfs[matching_file.stem] = [curr_df]
-                else:
-                    dfs[matching_file.stem].append(curr_df)
+        all_files = sorted(
+            (
+                (matching_file, session)
+                for session in self.sessions
+                for matching_file in (
+                    self.irl_path / "data" / "processed" / f"{session}"
+                ).glob("*.csv")
+            ),
+            key=lambda file_session: file_session[0].stem,
+        )
 
-        self.dfs = {file_type: pd.concat(df_list) for file_type, df_list in dfs.items()}
+        # one concat per file type, across all sessions
+        self.dfs = {
+            file_type: pd.concat(
+                [
+                    pd.read_csv(matching_file, index_col=0).assign(session=session)
+                    for matching_file, session in file_sessions
+                ],
+            )
+            for file_type, file_sessions in groupby(
+                all_files, key=lambda file_session: file_session[0].stem
+            )
+        }
 
         if not self.simulated:
             self.load_session_details()
@@ -322,8 +466,7 @@ class AnalysisObject:
             / "experiment_settings"
             / f"{self.experiment_setting}.yaml"
         )
-        with open(yaml_path, "r") as stream:
-            self.experiment_details = yaml.safe_load(stream)
+        self.experiment_details = load_yaml(yaml_path)
 
         self.optimization_data = self.load_optimization_data()
 
@@ -354,8 +497,11 @@ class AnalysisObject:
             / "cost_functions"
             / f"{self.cost_function}.yaml"
         )
-        with open(str(yaml_file), "r") as stream:
-            self.cost_details = yaml.safe_load(stream)
+        self.cost_details = load_yaml(yaml_file)
+        # resolve cost function by name once, rather than eval-ing it when needed
+        self._cost_function = getattr(
+            cost_functions, self.cost_details["cost_function"]
+        )
 
     def load_session_details(self):
         self.session_details = {}
@@ -368,12 +514,13 @@ class AnalysisObject:
                 / "experiments"
                 / f"{session}.yaml"
             )
-            with open(str(yaml_file), "r") as stream:
-                self.session_details[session] = yaml.safe_load(stream)
+            self.session_details[session] = load_yaml(yaml_file)
 
     def load_optimization_data(self):
         full_dfs = []
         self.model_name_mapping = {}
+        # integer id per model so queries compare ints rather than tuples
+        model_to_id = {}
         mle_and_map_files = [
             (
                 session,
@@ -389,52 +536,94 @@ class AnalysisObject:
             .drop_duplicates()
             .values
         ]
-        for session, mle_and_map_file in mle_and_map_files:
-            with open(
-                mle_and_map_file,
-                "rb",
-            ) as f:
-                data = pickle.load(f)
-            full_dfs.extend(
-                [
-                    {
-                        **random_record,
-                        f"map_{prior}": random_record["mle"],
-                        "prior": prior,
-                        "model": "None",
-                        "Model Name": "Null (Random)",
-                        "session": session,
-                        "Number Parameters": 0,
-                    }
-                    for random_record in data["RandomPolicy"].to_dict("records")
-                    for prior in data["SoftmaxPolicy"].keys()
-                ]
+
+        # list each session directory once, rather than hitting missing files
+        mle_and_map_dirs = {
+            mle_and_map_file.parent for _, mle_and_map_file in mle_and_map_files
+        }
+        existing_files = {}
+        for mle_and_map_dir in mle_and_map_dirs:
+            if mle_and_map_dir.is_dir():
+                with os.scandir(mle_and_map_dir) as entries:
+                    existing_files[mle_and_map_dir] = {entry.name for entry in entries}
+        missing_files = [
+            mle_and_map_file
+            for _, mle_and_map_file in mle_and_map_files
+            if mle_and_map_file.name
+            not in existing_files.get(mle_and_map_file.parent, set())
+        ]
+        if len(missing_files) == len(mle_and_map_files):
+            raise FileNotFoundError(
+                "No MLE and MAP files found in: "
+                + ", ".join(sorted(str(directory) for directory in mle_and_map_dirs))
             )
-            for prior, prior_dict in data["SoftmaxPolicy"].items():
-                all_params = max(prior_dict, key=len)
+        elif len(missing_files) > 0:
+            warnings.warn(
+                f"Skipping {len(missing_files)} missing MLE and MAP files: "
+                + ", ".join(str(missing_file) for missing_file in missing_files),
+                stacklevel=2,
+            )
+            missing_files = set(missing_files)
+            mle_and_map_files = [
+                (session, mle_and_map_file)
+                for session, mle_and_map_file in mle_and_map_files
+                if mle_and_map_file not in missing_files
+            ]
 
-                if self.included_parameters == "":
-                    included_parameters = set()
-                else:
-                    included_parameters = set(self.included_parameters.split(","))
+        # overlap reading the pickle files, since loading is mostly I/O
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            all_data = list(
+                executor.map(
+                    load_pickle,
+                    [mle_and_map_file for _, mle_and_map_file in mle_and_map_files],
+                )
+            )
+
+        # loop invariant parameter sets
+        if self.included_parameters == "":
+            included_parameters = frozenset()
+        else:
+            included_parameters = frozenset(self.included_parameters.split(","))
+        constant_set = frozenset(self.cost_details["constant_values"])
+        cost_param_set = frozenset(self.cost_details["cost_parameter_args"])
+
+        for (session, _), data in zip(mle_and_map_files, all_data):
+            random_df = data["RandomPolicy"]
+            for prior in data["SoftmaxPolicy"].keys():
+                full_dfs.append(
+                    random_df.assign(
+                        **{
+                            f"map_{prior}": random_df["mle"],
+                            "prior": prior,
+                            "model": "None",
+                            "model_id": model_to_id.setdefault(
+                                "None", len(model_to_id)
+                            ),
+                            "Model Name": "Null (Random)",
+                            "session": session,
+                            "Number Parameters": 0,
+                        }
+                    )
+                )
+            for prior, prior_dict in data["SoftmaxPolicy"].items():
+                all_params_set = frozenset(max(prior_dict, key=len))
+                must_contain = all_params_set - constant_set
 
                 for model, model_df in prior_dict.items():
-                    if set(model).intersection(included_parameters) == set():
-                        must_contain = set(all_params) - set(
-                            self.cost_details["constant_values"]
-                        )
+                    model_set = frozenset(model)
+                    if model_set.isdisjoint(included_parameters):
                         # in some cases, if we used a larger base cost model we will
                         # have an entry with param X held constant and not
                         # (when it always was for this cost function)
-                        if must_contain.issubset(set(model)):
+                        if must_contain.issubset(model_set):
                             # model is held constant parameters
-                            varied_parameters = set(all_params) - set(model)
+                            varied_parameters = all_params_set - model_set
                             number_parameters = len(varied_parameters)
                             cost_params_in_model = varied_parameters.intersection(
-                                set(self.cost_details["cost_parameter_args"])
+                                cost_param_set
                             )
                             additional_params_in_model = varied_parameters.difference(
-                                set(self.cost_details["cost_parameter_args"])
+                                cost_param_set
                             )
 
                             if len(cost_params_in_model) > 0:
@@ -466,24 +655,29 @@ class AnalysisObject:
                                     + "$"
                                 )
 
-                            self.model_name_mapping[
-                                tuple(param for param in sorted(model))
-                            ] = model_name
-                            full_dfs.extend(
-                                [
-                                    {
-                                        **softmax_record,
-                                        "prior": prior,
-                                        "model": model,
+                            self.model_name_mapping[tuple(sorted(model))] = model_name
+                            full_dfs.append(
+                                model_df.assign(
+                                    prior=prior,
+                                    # tuple would be broadcast as a list-like
+                                    model=[model] * len(model_df),
+                                    model_id=model_to_id.setdefault(
+                                        model, len(model_to_id)
+                                    ),
+                                    **{
                                         "Model Name": model_name,
                                         "session": session,
                                         "Number Parameters": number_parameters,
-                                    }
-                                    for softmax_record in model_df.to_dict("records")
-                                ]
+                                    },
+                                )
                             )
 
-        full_df = pd.DataFrame(full_dfs)
+        full_df = pd.concat(full_dfs, ignore_index=True)
+        # random policy has no held constant parameters to match on
+        self._id_to_model = {
+            model_id: frozenset(model) if isinstance(model, tuple) else None
+            for model, model_id in model_to_id.items()
+        }
         # delete old index column, if needed
         if "index" in full_df:
             del full_df["index"]
@@ -497,24 +691,22 @@ class AnalysisObject:
             mouselab_data["num_clicks"] = (
                 mouselab_data["num_clicks"] + 1
             )  # add terminal action
+        # only sum the column we join on
         full_df = self.join_optimization_df_and_processed(
             optimization_df=full_df,
-            processed_df=mouselab_data[
-                mouselab_data["block"].isin(self.block.split(","))
+            processed_df=mouselab_data.loc[
+                mouselab_data["block"].isin(self.block.split(",")),
+                ["pid", "num_clicks"],
             ]
-            .groupby(["pid"], as_index=False)
+            .groupby("pid", as_index=False, sort=False)["num_clicks"]
             .sum(),
             variables_of_interest=["num_clicks"],
         )
 
-        full_df["bic"] = full_df.apply(
-            lambda row: bic(
-                llf=row["mle"],
-                nobs=row["num_clicks"],
-                df_modelwc=row["Number Parameters"],
-            ),
-            axis=1,
-        )
+        # same as statsmodels.tools.eval_measures.bic, for whole columns
+        full_df["bic"] = -2.0 * full_df["mle"].to_numpy(dtype=np.float64) + np.log(
+            full_df["num_clicks"].to_numpy(dtype=np.float64)
+        ) * full_df["Number Parameters"].to_numpy(dtype=np.float64)
 
         return full_df
 
@@ -532,8 +724,7 @@ class AnalysisObject:
             / "yamls"
             / f"{self.experiment_name}.yaml"
         )
-        with open(str(yaml_file), "r") as stream:
-            yaml_dict = yaml.safe_load(stream)
+        yaml_dict = load_yaml(yaml_file)
         # append all entries in yaml_dict as attributes
         for key in yaml_dict:
             setattr(self, key, yaml_dict[key])
@@ -545,35 +736,29 @@ class AnalysisObject:
         variables_of_interest: List[str] = None,
     ) -> pd.DataFrame:
         if all(var in processed_df for var in variables_of_interest):
-            merged_df = optimization_df.merge(
-                processed_df[["pid", *variables_of_interest]],
-                left_on=[
-                    "trace_pid",
-                ],
-                right_on=["pid"],
-                how="left",
-            )
-            # delete pid in case we want to merge additional dataframes
-            # in the future
-            del merged_df["pid"]
+            # join on indexed right side, which also adds no pid column
+            merged_df = optimization_df.join(
+                processed_df.set_index("pid")[variables_of_interest],
+                on="trace_pid",
+            ).reset_index(drop=True)
             return merged_df
         elif all(var in optimization_df for var in variables_of_interest):
-            merged_df = processed_df.merge(
-                optimization_df[["trace_pid", *variables_of_interest]],
-                left_on=[
-                    "pid",
-                ],
-                right_on=["trace_pid"],
-                how="left",
-            )
-            # delete pid in case we want to merge additional dataframes
-            # in the future
-            del merged_df["trace_pid"]
+            merged_df = processed_df.join(
+                optimization_df.set_index("trace_pid")[variables_of_interest],
+                on="pid",
+            ).reset_index(drop=True)
             return merged_df
 
     def get_trial_by_trial_likelihoods(
         self,
+        n_jobs: int = 1,
     ) -> pd.DataFrame:
+        """
+        Get average likelihood of each trial, for each participant and model.
+
+        :param n_jobs: number of joblib workers used if likelihoods need to be computed, experiment setting must be registered on import of mouselab if not 1
+        :return: dataframe of average trial likelihoods
+        """  # noqa: E501
         trial_by_trial_file = (
             self.irl_path
             / "analysis"
@@ -594,6 +779,7 @@ class AnalysisObject:
             for excluded_parameters in self.trial_by_trial_models:
                 curr_trial_by_trial = self.compute_trial_by_trial_likelihoods(
                     excluded_parameters=excluded_parameters,
+                    n_jobs=n_jobs,
                 )
                 all_trial_by_trial[excluded_parameters] = curr_trial_by_trial
 
@@ -614,8 +800,7 @@ class AnalysisObject:
                 [
                     [
                         pid,
-                        sum([np.exp(action_ll) for action_ll in trial_ll])
-                        / len(trial_ll),
+                        float(np.exp(np.asarray(trial_ll)).mean()),
                         model_name,
                         excluded_parameters == self.excluded_parameters,
                         trial_num,
@@ -632,8 +817,15 @@ class AnalysisObject:
         return trial_by_trial_df
 
     def compute_trial_by_trial_likelihoods(
-        self, excluded_parameters: str = None
+        self, excluded_parameters: str = None, n_jobs: int = 1
     ) -> Dict[int, List[Any]]:
+        """
+        Compute likelihood of each trial for each participant, at their best parameters.
+
+        :param excluded_parameters: model, by parameters not fit
+        :param n_jobs: number of joblib workers the participants' parameter configurations are split between, experiment setting must be registered on import of mouselab if not 1
+        :return: dictionary of pid to list of action log likelihoods for each trial
+        """  # noqa: E501
         if excluded_parameters is None:
             excluded_parameters = self.excluded_parameters
 
@@ -658,20 +850,6 @@ class AnalysisObject:
 
         structure_dicts = get_structure_properties(structure_data)
 
-        q_function_generator = (
-            lambda cost_parameters, a, g: get_state_action_values(  # noqa : E731
-                experiment_setting=experiment_setting,
-                bmps_file="Myopic_VOC",
-                bmps_path=self.irl_path / "cluster" / "parameters" / "bmps",
-                cost_function=eval(self.cost_details["cost_function"]),
-                cost_parameters=cost_parameters,
-                structure=structure_dicts,
-                env_params=self.cost_details["env_params"],
-                kappa=a,
-                gamma=g,
-            )
-        )
-
         pid_to_best_params = (
             optimization_data[
                 list(self.cost_details["constant_values"]) + ["trace_pid"]
@@ -680,80 +858,45 @@ class AnalysisObject:
             .to_dict("index")
         )
 
-        trial_by_trial = {}
-        for pid, config in pid_to_best_params.items():
-            traces = get_trajectories_from_participant_data(
-                self.dfs["mouselab-mdp"][self.dfs["mouselab-mdp"]["pid"] == pid],
-                experiment_setting=experiment_setting,
-                include_last_action=self.cost_details["env_params"][
-                    "include_last_action"
-                ],
-            )
-
-            policy_kwargs = {
-                key: val
-                for key, val in config.items()
-                if key not in self.cost_details["cost_parameter_args"]
-            }
-
-            cost_kwargs = {
-                key: val
-                for key, val in config.items()
-                if key in self.cost_details["cost_parameter_args"]
-            }
+        # look up each participant's data by hash rather than filtering per pid
+        pid_dfs = {
+            pid: pid_df
+            for pid, pid_df in self.dfs["mouselab-mdp"].groupby("pid", sort=False)
+        }
+        pid_mles = (
+            optimization_data.drop_duplicates("trace_pid")
+            .set_index("trace_pid")["mle"]
+            .to_dict()
+        )
 
-            policy_kwargs["noise"] = 0
-            policy_kwargs["preference"] = q_function_generator(
-                cost_kwargs, policy_kwargs["kappa"], policy_kwargs["gamma"]
+        # participants often share the same best parameters, group them so
+        # q values are only solved once per configuration
+        config_to_pid_data = {}
+        for pid, config in pid_to_best_params.items():
+            config_to_pid_data.setdefault(tuple(sorted(config.items())), {})[pid] = (
+                pid_dfs[pid],
+                pid_mles[pid],
             )
 
-            participant = SymmetricMouselabParticipant(
+        results = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(_compute_trial_by_trial_for_config)(
+                config=dict(config_key),
+                pid_data=pid_data,
                 experiment_setting=experiment_setting,
-                policy_function=SoftmaxPolicy,
-                additional_mouselab_kwargs={
-                    "mdp_graph_properties": structure_dicts,
-                    **self.cost_details["env_params"],
-                },
-                num_trials=max([len(trace["actions"]) for trace in traces]),
-                cost_function=eval(self.cost_details["cost_function"]),
-                cost_kwargs=cost_kwargs,
-                policy_kwargs={
-                    key: val
-                    for key, val in policy_kwargs.items()
-                    if key not in ["gamma", "kappa"]
-                },
+                structure_dicts=structure_dicts,
+                cost_details=self.cost_details,
+                cost_function=self._cost_function,
+                bmps_path=self.irl_path / "cluster" / "parameters" / "bmps",
+                blocks=self.block.split(","),
             )
+            for config_key, pid_data in config_to_pid_data.items()
+        )
 
-            for trace in traces:
-                trace["states"] = [
-                    [
-                        adjust_state(
-                            state,
-                            policy_kwargs["gamma"],
-                            participant.mouselab_envs[0].mdp_graph.nodes.data("depth"),
-                            True,
-                        )
-                        for state in trial
-                    ]
-                    for trial in trace["states"]
-                ]
-
-                trial_by_trial[pid] = participant.compute_likelihood(trace)
-
-                sum_trial_by_trial = sum(
-                    [
-                        sum(trial_ll)
-                        for block, trial_ll in zip(trace["block"], trial_by_trial[pid])
-                        if block in self.block.split(",")
-                    ]
-                )
-                assert (
-                    sum_trial_by_trial
-                    - optimization_data[optimization_data["trace_pid"] == pid][
-                        "mle"
-                    ].values[0]
-                ) < 1e-3
-
+        trial_by_trial = {
+            pid: trial_lls
+            for config_trial_by_trial in results
+            for pid, trial_lls in config_trial_by_trial.items()
+        }
         return trial_by_trial
 
     def load_hdi_ranges(self, excluded_parameters: str = None):
@@ -800,7 +943,7 @@ class AnalysisObject:
         subset = self.optimization_data[
             (self.optimization_data["applied_policy"] == "SoftmaxPolicy")
             & (self.optimization_data["prior"] == prior)
-        ].copy(deep=True)
+        ]
         if include_null:
             # random policy doesn't have prior
             subset = pd.concat(
@@ -809,19 +952,20 @@ class AnalysisObject:
                     self.optimization_data[
                         (self.optimization_data["applied_policy"] == "RandomPolicy")
                         & (self.optimization_data["prior"] == prior)
-                    ].copy(deep=True),
-                ]
+                    ],
+                ],
             )
 
         if excluded_parameters is None:
             return subset
         elif excluded_parameters == "":
-            return subset[
-                subset["model"].apply(lambda model: set(model) == set())
-            ].copy(deep=True)
+            excluded_model = frozenset()
         else:
-            return subset[
-                subset["model"].apply(
-                    lambda model: set(model) == set(excluded_parameters.split(","))
-                )
-            ].copy(deep=True)
+            excluded_model = frozenset(excluded_parameters.split(","))
+
+        matching_ids = [
+            model_id
+            for model_id, model in self._id_to_model.items()
+            if model == excluded_model
+        ]
+        return subset[subset["model_id"].isin(matching_ids)]
@@ -1,12 +1,17 @@
 """These functions are used to transform human data to traces."""
-from typing import List
+from ast import literal_eval
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
 from mouselab.distributions import Categorical
 from mouselab.env_utils import get_num_actions
 from mouselab.envs.registry import registry
 from mouselab.mouselab import MouselabEnv
+from pandas.api.types import is_list_like
 
 
 def adjust_ground_truth(ground_truth, gamma, depth_view):
@@ -46,11 +51,73 @@ def adjust_state(state, gamma, depth_view, include_last_action=False):
     return tuple(new_state)
 
 
+# columns of mouselab-mdp dataframes which are saved as string encoded literals
+STRING_ENCODED_COLUMNS = [
+    "action_times",
+    "actions",
+    "rewards",
+    "path",
+    "state_rewards",
+    "queries",
+]
+
+
+def parse_property(value):
+    if isinstance(value, str):
+        return literal_eval(value)
+    else:
+        return value
+
+
 def get_row_property(row, column):
-    if isinstance(row[column], str):
-        return eval(row[column])
+    return parse_property(row[column])
+
+
+def fix_ground_truth(state_rewards):
+    """
+    Get ground truth from state rewards, with initial node 0.
+
+    :param state_rewards: parsed state rewards of a mouselab-mdp trial
+    :return: ground truth list
+    """
+    # depending on how mouselab file was processed starting node could be "" or dropped
+    if state_rewards[0] == "":
+        return [0] + state_rewards[1:]  # initial node 0
     else:
-        return row[column]
+        return [0] + state_rewards
+
+
+def get_click_targets(queries):
+    """
+    Get clicked nodes from queries.
+
+    :param queries: parsed queries of a mouselab-mdp trial
+    :return: list of clicked nodes, as integers
+    """
+    # clicks are saved as strings, cast all at once
+    return np.asarray(queries["click"]["state"]["target"], dtype=np.int64).tolist()
+
+
+# envs reused across traces, by setting and ground truth, with the registry entry
+# they were built from so a re-registered setting gets a new env
+_ENV_CACHE_SIZE = 1024
+_env_cache = {}
+
+
+def _cached_env(experiment_setting: str, ground_truth: Tuple[Any]):
+    setting = registry(experiment_setting)
+    cached_setting, env = _env_cache.get(
+        (experiment_setting, ground_truth), (None, None)
+    )
+    if cached_setting is not setting:
+        # drop oldest env if cache is full
+        if len(_env_cache) >= _ENV_CACHE_SIZE:
+            del _env_cache[next(iter(_env_cache))]
+        env = MouselabEnv.new_symmetric_registered(
+            experiment_setting, ground_truth=list(ground_truth)
+        )
+        _env_cache[(experiment_setting, ground_truth)] = (setting, env)
+    return env
 
 
 def get_states_for_trace(
@@ -62,28 +129,55 @@ def get_states_for_trace(
     :param actions:
     :param experiment_setting:
     :param ground_truth:
-    :return:
+    :return: dictionary of states (list), rewards (array) and finished
     """
-    env = MouselabEnv.new_symmetric_registered(
-        experiment_setting, ground_truth=ground_truth, **additional_mouselab_kwargs
-    )
-    state = env.reset()
+    if ground_truth is None or additional_mouselab_kwargs:
+        # without a ground truth a new one is sampled for every env
+        env = MouselabEnv.new_symmetric_registered(
+            experiment_setting, ground_truth=ground_truth, **additional_mouselab_kwargs
+        )
+    else:
+        # same trials are seen by many participants, so reuse env (reset below)
+        env = _cached_env(experiment_setting, tuple(ground_truth))
+    states = [env.reset()]
+    # one reward per action
+    rewards = np.empty(len(actions), dtype=np.float64)
 
     # finish initialize as -1, so if no action it will be -1
-    resulting_trace = {"rewards": [], "states": [state], "finished": -1}
+    done = -1
+
+    # bind methods once, this loop runs for every click of every trial
+    step = env.step
+    add_state = states.append
+    for action_idx, click in enumerate(actions):
+        state, rewards[action_idx], done, _ = step(int(click))
+        add_state(state)
+
+    # on off-chance person quit half way we might have a False
+    return {"rewards": rewards, "states": states, "finished": done}
+
+
+@lru_cache(maxsize=None)
+def _final_action_for_branching(branching: Tuple[int]) -> int:
+    return get_num_actions(list(branching))
 
-    for click in actions:
-        state, reward, done, _ = env.step(int(click))
-        resulting_trace["states"].append(state)
-        resulting_trace["rewards"].append(reward)
-        resulting_trace[
-            "finished"
-        ] = done  # on off-chance person quit half way we might have a False
-    return resulting_trace
+
+def get_final_action(experiment_setting: str) -> int:
+    """
+    Get terminal action of a (registered) mouselab setting.
+
+    :param experiment_setting: which (registered) mouselab setting is being used
+    :return: terminal action
+    """
+    # cached by branching rather than name, since settings can be re-registered
+    return _final_action_for_branching(tuple(registry(experiment_setting).branching))
 
 
 def get_trace_from_human_row(
-    row, experiment_setting: str, include_last_action: bool = False
+    row,
+    experiment_setting: str,
+    include_last_action: bool = False,
+    final_action: int = None,
 ):
     """
     Transform a human row to a trace.
@@ -91,73 +185,104 @@ def get_trace_from_human_row(
     :param row: row in mouselab dataframe
     :param experiment_setting: which (registered) mouselab setting is being used
     :param include_last_action:
+    :param final_action: terminal action of setting, looked up if not provided
     :return:
     """
-    human_trace = {}
-
-    # human only fields
-    human_trace["movement_times"] = get_row_property(row, "action_times")
-    human_trace["moves"] = get_row_property(row, "actions")
-    human_trace["movement_rewards"] = get_row_property(row, "rewards")
-    human_trace["path"] = get_row_property(row, "path")
-    human_trace["block"] = row["block"]
-    human_trace["trial_id"] = row["trial_id"]
-
-    # ground truth for trial
-    ground_truth_trial = get_row_property(row, "state_rewards")
-    # depending on how mouselab file was processed starting node could be "" or dropped
-    if ground_truth_trial[0] == "":
-        ground_truth_trial[0] = 0  # initial node 0
+    if final_action is None:
+        final_action = get_final_action(experiment_setting)
+
+    # ground truth for trial, already fixed if row is from a whole dataframe
+    if "_ground_truth" in row:
+        ground_truth_trial = row["_ground_truth"]
     else:
-        ground_truth_trial = [0] + ground_truth_trial
-    human_trace["ground_truth"] = ground_truth_trial
-    human_trace["trial_id"] = row["trial_id"]
+        ground_truth_trial = fix_ground_truth(get_row_property(row, "state_rewards"))
 
     # not just actions, but also timing
-    human_trace["queries"] = get_row_property(row, "queries")
-
-    # fields in simulation traces (i_episode, states, actions rewards, finished, return)
+    queries = get_row_property(row, "queries")
 
-    # episode number
-    human_trace["i_episode"] = int(row["trial_index"])
-
-    human_trace["actions"] = [
-        int(click) for click in human_trace["queries"]["click"]["state"]["target"]
-    ] + [
-        get_num_actions(registry(experiment_setting).branching)
-    ]  # add final action
+    # click targets, already extracted if row is from a whole dataframe
+    if "_targets" in row:
+        clicks = row["_targets"]
+    else:
+        clicks = get_click_targets(queries)
+    actions = clicks + [final_action]  # add final action
 
-    for trace_key, trace_val in get_states_for_trace(
-        human_trace["actions"],
+    # states, rewards and finished
+    states_for_trace = get_states_for_trace(
+        actions,
         experiment_setting,
         ground_truth=ground_truth_trial,
-    ).items():
-        human_trace[trace_key] = trace_val
-
-    # return
-    human_trace["return"] = sum(human_trace["rewards"]) + sum(
-        human_trace["movement_rewards"]
     )
 
-    # pid
-    human_trace["pid"] = row["pid"]
+    movement_rewards = get_row_property(row, "rewards")
+
+    human_trace = {
+        # human only fields
+        "movement_times": get_row_property(row, "action_times"),
+        "moves": get_row_property(row, "actions"),
+        "movement_rewards": movement_rewards,
+        "path": get_row_property(row, "path"),
+        "block": row["block"],
+        "trial_id": row["trial_id"],
+        "ground_truth": ground_truth_trial,
+        "queries": queries,
+        "i_episode": int(row["trial_index"]),  # episode number
+        "actions": actions,
+        **states_for_trace,
+        "return": float(states_for_trace["rewards"].sum())
+        + float(np.sum(movement_rewards)),
+        "pid": row["pid"],
+    }
 
     if include_last_action:
         human_trace["states"] = [
             (*state, last_action)
-            for state, last_action in zip(
-                human_trace["states"], [0] + human_trace["actions"][:-1]
-            )
+            for state, last_action in zip(human_trace["states"], [0] + actions[:-1])
         ]
 
     return human_trace
 
 
+def _get_traces_for_pid_dfs(
+    pid_dfs: List[Tuple[Any, pd.DataFrame]],
+    experiment_setting: str,
+    include_last_action: bool = False,
+) -> List[Tuple[Any, List[Dict[str, Any]]]]:
+    """
+    Transform each participant's rows to traces, one per row.
+
+    :param pid_dfs: list of (pid, dataframe of that participant's trials)
+    :param experiment_setting: which (registered) mouselab setting is being used
+    :param include_last_action:
+    :return: list of (pid, list of traces for each row)
+    """
+    # same for every row
+    final_action = get_final_action(experiment_setting)
+
+    # rows are passed as plain dictionaries since building a Series per row is slow
+    return [
+        (
+            pid,
+            [
+                get_trace_from_human_row(
+                    row,
+                    experiment_setting,
+                    include_last_action=include_last_action,
+                    final_action=final_action,
+                )
+                for row in pid_df.to_dict("records")
+            ],
+        )
+        for pid, pid_df in pid_dfs
+    ]
+
+
 def get_trajectories_from_participant_data(
     mouselab_mdp_dataframe,
     experiment_setting: str = "high_increasing",
     blocks: List[str] = None,
     include_last_action: bool = False,
+    n_jobs: int = 1,
 ):
     """
     Get trajectories for participants in a Mouselab MDP dataframe, given an experiment setting.
@@ -166,6 +291,7 @@ def get_trajectories_from_participant_data(
     :param experiment_setting:
     :param blocks:
     :param include_last_action:
+    :param n_jobs: number of joblib workers participants are split between, experiment setting must be registered on import of mouselab if not 1
     :return: Dictionary with same structure as a `trace` in mouselab-mdp
     """  # noqa: E501
     if blocks:
@@ -173,21 +299,80 @@ def get_trajectories_from_participant_data(
             mouselab_mdp_dataframe["block"].isin(blocks)
         ]
 
-    # split dataframes into dataframe per subject
+    # parse string encoded columns once, rather than once per row access
+    # (state rewards are only needed once per trial, below)
+    mouselab_mdp_dataframe = mouselab_mdp_dataframe.assign(
+        **{
+            column: mouselab_mdp_dataframe[column].map(parse_property)
+            for column in STRING_ENCODED_COLUMNS
+            if column != "state_rewards"
+        }
+    )
+
+    # only keep columns used to create traces
+    mouselab_mdp_dataframe = mouselab_mdp_dataframe[
+        ["pid", "block", "trial_id", "trial_index", *STRING_ENCODED_COLUMNS]
+    ]
+
+    # same trial is seen by many participants, so parse and fix each distinct
+    # state rewards once (already parsed lists can't be hashed, fix those per row)
+    state_rewards = mouselab_mdp_dataframe["state_rewards"]
+    if all(isinstance(entry, str) for entry in state_rewards):
+        gt_by_state_rewards = {
+            entry: fix_ground_truth(parse_property(entry))
+            for entry in state_rewards.unique()
+        }
+        ground_truths = state_rewards.map(gt_by_state_rewards.__getitem__)
+    else:
+        ground_truths = state_rewards.map(
+            lambda entry: fix_ground_truth(parse_property(entry))
+        )
+
+    # fix ground truths and extract clicks for the whole dataframe,
+    # rather than in each row
+    mouselab_mdp_dataframe = mouselab_mdp_dataframe.assign(
+        _ground_truth=ground_truths,
+        _targets=mouselab_mdp_dataframe["queries"].map(get_click_targets),
+    )
+
+    # split dataframes into dataframe per subject, in order of first appearance
+    pid_dfs = list(mouselab_mdp_dataframe.groupby("pid", sort=False, observed=True))
+
+    # one contiguous chunk of participants per worker, to limit pickling
+    num_chunks = max(min(effective_n_jobs(n_jobs), len(pid_dfs)), 1)
+    chunk_size = max(-(-len(pid_dfs) // num_chunks), 1)
+    pid_df_chunks = [
+        pid_dfs[chunk_start : chunk_start + chunk_size]
+        for chunk_start in range(0, len(pid_dfs), chunk_size)
+    ]
+
+    if len(pid_df_chunks) > 1:
+        chunk_traces = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(_get_traces_for_pid_dfs)(
+                pid_df_chunk, experiment_setting, include_last_action
+            )
+            for pid_df_chunk in pid_df_chunks
+        )
+    else:
+        chunk_traces = [
+            _get_traces_for_pid_dfs(
+                pid_df_chunk, experiment_setting, include_last_action
+            )
+            for pid_df_chunk in pid_df_chunks
+        ]
+
     mouselab_dict_traces = {
-        pid: pid_df.apply(
-            lambda row: get_trace_from_human_row(
-                row, experiment_setting, include_last_action=include_last_action
-            ),
-            axis=1,
-        ).values
-        for pid, pid_df in mouselab_mdp_dataframe.groupby("pid")
+        pid: dict_trace for pid_traces in chunk_traces for pid, dict_trace in pid_traces
     }
 
-    mouselab_mdp_traces = [
-        {key: [sub_dict[key] for sub_dict in dict_trace] for key in dict_trace[0]}
-        for pid, dict_trace in mouselab_dict_traces.items()
-    ]
+    # transpose list of trial dicts to dict of lists, with the same keys as first
+    mouselab_mdp_traces = []
+    for dict_trace in mouselab_dict_traces.values():
+        keys = list(dict_trace[0])
+        get_values = itemgetter(*keys)
+        mouselab_mdp_traces.append(
+            dict(zip(keys, map(list, zip(*map(get_values, dict_trace)))))
+        )
 
     return mouselab_mdp_traces
 
@@ -199,37 +384,64 @@ def traces_to_df(traces):
     :param traces:
     :return:
     """
-    all_trace_dfs = []
+    # columns for all traces, built up and turned into one dataframe at the end
+    columns = {}
+    episode_indices = []
+    num_rows = 0
     for trace in traces:
-        # because s and a are lists of lists, we combine them
-        #                          and then use pandas explode
-        trace["s,a,r"] = []
+        # take s, a and r out of trace so nested lists can be freed once flattened
+        trace_states = trace.pop("states")
+        trace_actions = trace.pop("actions")
+        trace_rewards = trace.pop("rewards")
+
+        # flatten s, a and r of all episodes, one row per step
+        states = []
+        actions = []
+        rewards = []
+        num_steps = []
         for i_episode in trace["i_episode"]:
-            # remove final terminal state so s and a are both same size
-            if "__term_state__" in trace["states"][i_episode]:
-                trace["states"][i_episode].remove("__term_state__")
-            trace["s,a,r"].append(
-                list(
-                    zip(
-                        trace["states"][i_episode],
-                        trace["actions"][i_episode],
-                        trace["rewards"][i_episode],
-                    )
-                )
+            # remove final terminal state so s and a are both same size,
+            # terminal state is always the last state of an episode
+            episode_states = trace_states[i_episode]
+            if episode_states and episode_states[-1] == "__term_state__":
+                episode_states.pop()
+            # as with zip, only steps with a state, action and reward are kept
+            episode_steps = min(
+                len(episode_states),
+                len(trace_actions[i_episode]),
+                len(trace_rewards[i_episode]),
             )
-
-        del trace["states"]
-        del trace["actions"]
-        del trace["rewards"]
-
-        trace_df = pd.DataFrame.from_dict(trace)
-        trace_df = trace_df.explode("s,a,r")
-        # add states and actions back again, delete s,a
-        trace_df["states"] = trace_df["s,a,r"].apply(lambda sa: sa[0])
-        trace_df["actions"] = trace_df["s,a,r"].apply(lambda sa: sa[1])
-        trace_df["rewards"] = trace_df["s,a,r"].apply(lambda sa: sa[2])
-        del trace_df["s,a,r"]
-
-        all_trace_dfs.append(trace_df)
-
-    return pd.concat(all_trace_dfs)
+            states.extend(episode_states[:episode_steps])
+            actions.extend(trace_actions[i_episode][:episode_steps])
+            rewards.extend(trace_rewards[i_episode][:episode_steps])
+            num_steps.append(episode_steps)
+        del trace_states, trace_actions, trace_rewards
+
+        # other fields have one entry per episode (or one for all episodes),
+        # repeated for each step of the episode
+        episode_idx = np.repeat(np.arange(len(trace["i_episode"])), num_steps)
+        for key, val in {
+            **trace,
+            "states": states,
+            "actions": actions,
+            "rewards": rewards,
+        }.items():
+            # fields missing from earlier traces are NaN, as in a concat
+            column = columns.setdefault(key, [np.nan] * num_rows)
+            if key in ["states", "actions", "rewards"]:
+                column.extend(val)
+            elif is_list_like(val):
+                # one run of the same value for each episode
+                for episode_val, episode_steps in zip(val, num_steps):
+                    column.extend([episode_val] * episode_steps)
+            else:
+                column.extend([val] * len(episode_idx))
+
+        num_rows += len(episode_idx)
+        episode_indices.append(episode_idx)
+
+        # fields missing from this trace
+        for column in columns.values():
+            column.extend([np.nan] * (num_rows - len(column)))
+
+    return pd.DataFrame(columns, index=np.concatenate(episode_indices))
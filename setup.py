@@ -26,11 +26,11 @@ setup(
         # plus commit that fixes typo: https://github.com/openai/gym/issues/3202
         "gym @ git+https://github.com/openai/gym.git@9180d12e1b66e7e2a1a622614f787a6ec147ac40",
         "hyperopt",
+        "joblib",
         "mouselab @ git+https://github.com/RationalityEnhancementGroup/mouselab-mdp-tools.git@dev#egg=mouselab",  # noqa
         "numpy",
         "pandas",
         "pyyaml",
-        "statsmodels",
         "tqdm",
     ],
 )
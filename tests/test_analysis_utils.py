@@ -0,0 +1,115 @@
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import dill as pickle
+import pandas as pd
+from parameterized import parameterized
+
+from costometer.utils.analysis_utils import AnalysisObject, get_best_parameters
+
+cost_details = {"constant_values": {"a": 0, "b": 0}}
+priors = {"uniform": {"a": {0: 0.5, 1: 0.5}, "b": {0: 0.5, 1: 0.5}}}
+
+# first three rows of each participant tie for max MAP when no parameter is constant
+tied_df = pd.DataFrame(
+    [
+        {"trace_pid": "p", "sim_cost": 1, "a": 1, "b": 1, "mle": -1.0},
+        {"trace_pid": "p", "sim_cost": 1, "a": 0, "b": 1, "mle": -1.0},
+        {"trace_pid": "p", "sim_cost": 1, "a": 1, "b": 0, "mle": -1.0},
+        {"trace_pid": "p", "sim_cost": 1, "a": 0, "b": 0, "mle": -2.0},
+        {"trace_pid": "q", "sim_cost": 1, "a": 1, "b": 1, "mle": -1.0},
+        {"trace_pid": "q", "sim_cost": 1, "a": 1, "b": 0, "mle": -1.0},
+        {"trace_pid": "q", "sim_cost": 1, "a": 0, "b": 1, "mle": -1.0},
+        {"trace_pid": "q", "sim_cost": 1, "a": 0, "b": 0, "mle": -2.0},
+    ]
+)
+
+test_best_parameters = [
+    # more constant values win ties, then first row among remaining ties
+    [(), {"p": (0, 1), "q": (1, 0)}],
+    # only rows with constant parameter, max MAP wins over more constant values
+    [("a",), {"p": (0, 1), "q": (0, 1)}],
+    [("b",), {"p": (1, 0), "q": (1, 0)}],
+    [("a", "b"), {"p": (0, 0), "q": (0, 0)}],
+]
+
+
+def get_optimization_analysis_object(irl_path, pids):
+    """Get AnalysisObject with only attributes needed to load optimization data."""
+    # skip __init__, which reads a whole experiment's files
+    analysis_obj = AnalysisObject.__new__(AnalysisObject)
+    analysis_obj.irl_path = irl_path
+    analysis_obj.cost_function = "linear_depth"
+    analysis_obj.block = "test"
+    analysis_obj.included_parameters = ""
+    analysis_obj.simulated = True
+    analysis_obj.cost_details = {
+        **cost_details,
+        "cost_parameter_args": ["a", "b"],
+        "latex_mapping": {"a": "a", "b": "b"},
+    }
+    analysis_obj.dfs = {
+        "mouselab-mdp": pd.DataFrame(
+            {
+                "pid": pids,
+                "session": "session",
+                "block": "test",
+                "num_clicks": 2,
+            }
+        )
+    }
+    return analysis_obj
+
+
+def save_mle_and_map_file(irl_path, pid):
+    """Save MLE and MAP file for one participant, with a random and two models."""
+    mle_and_map_dir = (
+        irl_path / "data" / "processed" / "session" / "linear_depth" / "mle_and_map"
+    )
+    mle_and_map_dir.mkdir(parents=True, exist_ok=True)
+
+    model_df = pd.DataFrame({"trace_pid": [pid], "a": [0], "b": [0], "mle": [-1.0]})
+    with open(mle_and_map_dir / f"_{pid}.pickle", "wb") as f:
+        pickle.dump(
+            {
+                "RandomPolicy": model_df,
+                "SoftmaxPolicy": {"uniform": {(): model_df, ("a", "b"): model_df}},
+            },
+            f,
+        )
+
+
+class TestAnalysisUtils(unittest.TestCase):
+    @parameterized.expand(test_best_parameters)
+    def test_get_best_parameters_ties(self, subset, expected_params):
+        best_parameters = get_best_parameters(tied_df, cost_details, priors)
+        best_param_rows = best_parameters["uniform"][subset]
+
+        self.assertEqual(
+            {
+                row["trace_pid"]: (row["a"], row["b"])
+                for row in best_param_rows.to_dict("records")
+            },
+            expected_params,
+        )
+
+    def test_load_optimization_data_missing_file(self):
+        with TemporaryDirectory() as irl_path:
+            irl_path = Path(irl_path)
+            save_mle_and_map_file(irl_path, pid=1)
+            analysis_obj = get_optimization_analysis_object(irl_path, pids=[1, 2])
+
+            with self.assertWarnsRegex(UserWarning, "Skipping 1 missing"):
+                optimization_data = analysis_obj.load_optimization_data()
+
+        # random policy and both models, only for participant with file
+        self.assertEqual(optimization_data["trace_pid"].tolist(), [1, 1, 1])
+        self.assertEqual(optimization_data["Number Parameters"].tolist(), [0, 2, 0])
+
+    def test_load_optimization_data_no_files(self):
+        with TemporaryDirectory() as irl_path:
+            analysis_obj = get_optimization_analysis_object(Path(irl_path), pids=[1])
+
+            with self.assertRaisesRegex(FileNotFoundError, "mle_and_map"):
+                analysis_obj.load_optimization_data()
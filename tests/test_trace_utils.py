@@ -0,0 +1,224 @@
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from mouselab.mouselab import MouselabEnv
+
+from costometer.utils import (
+    get_states_for_trace,
+    get_trace_from_human_row,
+    get_trajectories_from_participant_data,
+    traces_to_df,
+)
+from costometer.utils.trace_utils import (
+    fix_ground_truth,
+    get_click_targets,
+    get_final_action,
+    parse_property,
+)
+
+mouselab_file = Path(__file__).parents[0].joinpath("inputs/fake_data/mouselab_mdp.csv")
+
+
+def get_traces_row_by_row(mouselab_mdp_dataframe, experiment_setting):
+    """Get traces for each participant by transforming one (unparsed) row at a time."""
+    traces = []
+    for _, pid_df in mouselab_mdp_dataframe.groupby("pid", sort=False):
+        trial_traces = [
+            get_trace_from_human_row(row, experiment_setting)
+            for _, row in pid_df.iterrows()
+        ]
+        traces.append(
+            {key: [trace[key] for trace in trial_traces] for key in trial_traces[0]}
+        )
+    return traces
+
+
+def get_df_step_by_step(traces):
+    """Flatten traces to one record per step, as traces_to_df used to with explode."""
+    records = []
+    index = []
+    for trace in traces:
+        other_fields = [
+            key for key in trace if key not in ["states", "actions", "rewards"]
+        ]
+        for episode_idx, i_episode in enumerate(trace["i_episode"]):
+            states = [
+                state
+                for state in trace["states"][i_episode]
+                if state != "__term_state__"
+            ]
+            for state, action, reward in zip(
+                states, trace["actions"][i_episode], trace["rewards"][i_episode]
+            ):
+                records.append(
+                    {
+                        **{key: trace[key][episode_idx] for key in other_fields},
+                        "states": state,
+                        "actions": action,
+                        "rewards": reward,
+                    }
+                )
+                index.append(episode_idx)
+    return pd.DataFrame.from_records(records, index=index)
+
+
+def comparable_state(state):
+    """Replace distributions in state with their values and probabilities."""
+    if state == "__term_state__":
+        return state
+    return tuple(
+        (node.vals, node.probs) if hasattr(node, "sample") else node for node in state
+    )
+
+
+class TestTraceUtils(unittest.TestCase):
+    def setUp(self):
+        self.mouselab_mdp_dataframe = pd.read_csv(mouselab_file, index_col=0)
+        self.experiment_setting = "high_increasing"
+
+    def assert_traces_equal(self, traces, expected_traces):
+        self.assertEqual(len(traces), len(expected_traces))
+        for trace, expected_trace in zip(traces, expected_traces):
+            self.assertEqual(list(trace), list(expected_trace))
+            for key, expected_vals in expected_trace.items():
+                if key == "rewards":
+                    for trial_rewards, expected_rewards in zip(
+                        trace[key], expected_vals
+                    ):
+                        np.testing.assert_array_equal(trial_rewards, expected_rewards)
+                else:
+                    self.assertEqual(trace[key], expected_vals)
+
+    def test_trajectories_match_row_by_row(self):
+        traces = get_trajectories_from_participant_data(
+            self.mouselab_mdp_dataframe, experiment_setting=self.experiment_setting
+        )
+        expected_traces = get_traces_row_by_row(
+            self.mouselab_mdp_dataframe, self.experiment_setting
+        )
+        self.assert_traces_equal(traces, expected_traces)
+
+        # ground truth has initial node 0 instead of ""
+        first_trial = self.mouselab_mdp_dataframe.iloc[0]
+        self.assertEqual(
+            traces[0]["ground_truth"][0],
+            [0, -2, -4, 48, -24, 4, -8, 48, -48, 2, -8, 24, -48],
+        )
+        self.assertEqual(traces[0]["trial_id"][0], first_trial["trial_id"])
+
+    def test_reused_env_matches_fresh_env(self):
+        trials = self.mouselab_mdp_dataframe[
+            self.mouselab_mdp_dataframe["pid"] == 0
+        ].to_dict("records")
+        ground_truth = fix_ground_truth(parse_property(trials[2]["state_rewards"]))
+        final_action = get_final_action(self.experiment_setting)
+        actions = [
+            get_click_targets(parse_property(trial["queries"])) + [final_action]
+            for trial in trials[2:4]
+        ]
+
+        # first use env for other clicks, so second trace reuses a stepped env
+        get_states_for_trace(
+            actions[1], self.experiment_setting, ground_truth=ground_truth
+        )
+        trace = get_states_for_trace(
+            actions[0], self.experiment_setting, ground_truth=ground_truth
+        )
+
+        env = MouselabEnv.new_symmetric_registered(
+            self.experiment_setting, ground_truth=ground_truth
+        )
+        expected_states = [env.reset()]
+        expected_rewards = []
+        for action in actions[0]:
+            state, reward, done, _ = env.step(action)
+            expected_states.append(state)
+            expected_rewards.append(reward)
+
+        self.assertEqual(
+            [comparable_state(state) for state in trace["states"]],
+            [comparable_state(state) for state in expected_states],
+        )
+        np.testing.assert_array_equal(trace["rewards"], expected_rewards)
+        self.assertEqual(trace["finished"], done)
+
+    def test_trajectories_unsorted_pids(self):
+        traces = get_trajectories_from_participant_data(
+            self.mouselab_mdp_dataframe, experiment_setting=self.experiment_setting
+        )
+        traces_by_pid = {trace["pid"][0]: trace for trace in traces}
+
+        pid_order = [2, 0, 1]
+        unsorted_dataframe = pd.concat(
+            [
+                self.mouselab_mdp_dataframe[self.mouselab_mdp_dataframe["pid"] == pid]
+                for pid in pid_order
+            ]
+        )
+        unsorted_traces = get_trajectories_from_participant_data(
+            unsorted_dataframe, experiment_setting=self.experiment_setting
+        )
+
+        # participants are returned in order of first appearance
+        self.assertEqual([trace["pid"][0] for trace in unsorted_traces], pid_order)
+        self.assert_traces_equal(
+            unsorted_traces, [traces_by_pid[pid] for pid in pid_order]
+        )
+
+    def test_traces_to_df_match_step_by_step(self):
+        traces = get_trajectories_from_participant_data(
+            self.mouselab_mdp_dataframe, experiment_setting=self.experiment_setting
+        )
+        # traces_to_df indexes states, actions and rewards by episode number
+        for trace in traces:
+            trace["i_episode"] = list(range(len(trace["i_episode"])))
+
+        expected_df = get_df_step_by_step(traces)
+        # traces_to_df removes fields from each trace, so pass shallow copies
+        trace_df = traces_to_df([dict(trace) for trace in traces])
+
+        self.assertEqual(len(trace_df), len(expected_df))
+        self.assertEqual(list(trace_df.index), list(expected_df.index))
+        self.assertEqual(list(trace_df.columns), list(expected_df.columns))
+        for column in expected_df.columns:
+            self.assertEqual(trace_df[column].tolist(), expected_df[column].tolist())
+
+    def test_traces_to_df_extra_field(self):
+        traces = [
+            {
+                "pid": [1, 1],
+                "i_episode": [0, 1],
+                "states": [
+                    [(0, 1), (0, 2), "__term_state__"],
+                    [(0, 3), "__term_state__"],
+                ],
+                "actions": [[1, 13], [13]],
+                "rewards": [[-1.0, 5.0], [3.0]],
+                "return": [4.0, 3.0],
+            },
+            {
+                "pid": [0],
+                "i_episode": [0],
+                "states": [[(1, 1), (1, 2), (1, 3), "__term_state__"]],
+                "actions": [[2, 3, 13]],
+                "rewards": [[-1.0, -1.0, 7.0]],
+                "return": [5.0],
+                "extra": ["x"],
+            },
+        ]
+        expected_df = pd.DataFrame(
+            {
+                "pid": [1, 1, 1, 0, 0, 0],
+                "i_episode": [0, 0, 1, 0, 0, 0],
+                "return": [4.0, 4.0, 3.0, 5.0, 5.0, 5.0],
+                "states": [(0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3)],
+                "actions": [1, 13, 13, 2, 3, 13],
+                "rewards": [-1.0, 5.0, 3.0, -1.0, -1.0, 7.0],
+                # field missing from first trace is NaN
+                "extra": [np.nan, np.nan, np.nan, "x", "x", "x"],
+            },
+            index=[0, 0, 1, 0, 0, 0],
+        )
+        pd.testing.assert_frame_equal(traces_to_df(traces), expected_df)